@@ -4,12 +4,16 @@ import asyncio
 import logging
 
 import aiohttp
-from aiohttp import web
+import orjson
+from aiohttp import hdrs, web
+from aiohttp.abc import AbstractResolver
+from aiohttp.resolver import DefaultResolver
 from aiohttp_socks import ProxyConnector
+from multidict import CIMultiDict
 
 from config import settings
 from db import models
-from services.vless import is_xray_running
+from services.vless import SOCKS_BASE_PORT, get_xray_generation, is_xray_running
 
 logger = logging.getLogger(__name__)
 
@@ -22,37 +26,111 @@ HOP_BY_HOP = frozenset({
 })
 
 
-def _get_connector(vless_config_index: int | None) -> ProxyConnector | None:
-    if not is_xray_running() or vless_config_index is None:
-        return None
-    port = 10801 + vless_config_index
-    return ProxyConnector.from_url(f"socks5://127.0.0.1:{port}")
+UPSTREAM_TIMEOUT = aiohttp.ClientTimeout(total=180)
+SMALL_BODY_LIMIT = 16 * 1024
+RETRY_BODY_LIMIT = 64 * 1024
 
+# Long-lived upstream sessions keyed by vless_config_index (None = direct)
+SESSIONS = web.AppKey("sessions", dict)
+SESSIONS_LOCK = web.AppKey("sessions_lock", asyncio.Lock)
+# XRAY generation the tunnel sessions were built for
+SESSIONS_XRAY_GEN = web.AppKey("sessions_xray_gen", int)
+# One DNS resolver shared by the direct connectors
+RESOLVER = web.AppKey("resolver", AbstractResolver)
 
-async def _authenticate(request: web.Request) -> tuple[dict | None, web.Response | None]:
+
+def json_response(data, status: int = 200) -> web.Response:
+    """JSON response serialized with orjson."""
+    return web.Response(body=orjson.dumps(data), status=status, content_type="application/json")
+
+
+# Static auth error bodies, serialized once
+_MISSING_AUTH_BODY = orjson.dumps({"error": "Missing or invalid Authorization header. Use: Bearer <token>"})
+_INVALID_TOKEN_BODY = orjson.dumps({"error": "Invalid or revoked token"})
+
+
+def _unauthorized(body: bytes) -> web.Response:
+    return web.Response(body=body, status=401, content_type="application/json")
+
+
+class _StreamAborted(Exception):
+    """Upstream failed after the response headers were already sent to the client."""
+
+    def __init__(self, response: web.StreamResponse):
+        super().__init__()
+        self.response = response
+
+
+def _create_session(
+    vless_config_index: int | None, resolver: AbstractResolver,
+) -> aiohttp.ClientSession:
+    """Build a pooled session, tunnelled through XRAY SOCKS5 when an index is given."""
+    pool = {"limit": 0, "limit_per_host": 100, "keepalive_timeout": 75}
+    if vless_config_index is None:
+        connector = aiohttp.TCPConnector(resolver=resolver, ttl_dns_cache=300, **pool)
+    else:
+        # ProxyConnector always installs its own NoResolver: XRAY resolves
+        # the upstream host, so DNS settings would be ignored here
+        port = SOCKS_BASE_PORT + vless_config_index
+        connector = ProxyConnector.from_url(f"socks5://127.0.0.1:{port}", **pool)
+    # Bodies are relayed as-is, so upstream Content-Encoding/Length stay valid
+    return aiohttp.ClientSession(connector=connector, timeout=UPSTREAM_TIMEOUT, auto_decompress=False)
+
+
+async def _drop_tunnel_sessions(app: web.Application):
+    """Close sessions bound to the previous XRAY process; its tunnels are gone."""
+    sessions = app[SESSIONS]
+    for idx in [i for i in sessions if i is not None]:
+        await sessions.pop(idx).close()
+    app[SESSIONS_XRAY_GEN] = get_xray_generation()
+
+
+async def _get_session(app: web.Application, vless_config_index: int | None) -> aiohttp.ClientSession:
+    """Return the cached session for a VLESS tunnel, creating it on first use."""
+    if not is_xray_running():
+        vless_config_index = None
+    sessions = app[SESSIONS]
+    stale = vless_config_index is not None and app[SESSIONS_XRAY_GEN] != get_xray_generation()
+    session = None if stale else sessions.get(vless_config_index)
+    if session is None:
+        async with app[SESSIONS_LOCK]:
+            if app[SESSIONS_XRAY_GEN] != get_xray_generation():
+                await _drop_tunnel_sessions(app)
+            session = sessions.get(vless_config_index)
+            if session is None:
+                session = _create_session(vless_config_index, app[RESOLVER])
+                sessions[vless_config_index] = session
+    return session
+
+
+async def _authenticate(request: web.Request) -> tuple[models.Token | None, web.Response | None]:
     """Validate Bearer token from Authorization header."""
-    auth = request.headers.get("Authorization", "")
-    if not auth.startswith("Bearer "):
-        return None, web.json_response(
-            {"error": "Missing or invalid Authorization header. Use: Bearer <token>"},
-            status=401,
-        )
+    auth = request.headers.get(hdrs.AUTHORIZATION)
+    if not auth:
+        return None, _unauthorized(_MISSING_AUTH_BODY)
+    token_value = auth.removeprefix("Bearer ")
+    if token_value is auth:  # prefix absent
+        return None, _unauthorized(_MISSING_AUTH_BODY)
 
-    token_value = auth[7:]
     token = await models.get_token_by_value(token_value)
     if token is None:
-        return None, web.json_response({"error": "Invalid or revoked token"}, status=401)
+        return None, _unauthorized(_INVALID_TOKEN_BODY)
 
     return token, None
 
 
-def _forward_headers(request_headers: dict, api_key: str) -> dict:
+def _strip_hop_by_hop(headers) -> CIMultiDict:
+    """Copy headers without hop-by-hop ones (case-insensitive removal in C)."""
+    result = CIMultiDict(headers)
+    for name in HOP_BY_HOP:
+        result.popall(name, None)
+    return result
+
+
+def _forward_headers(request_headers, api_key: str) -> CIMultiDict:
     """Build headers for upstream request: replace auth, drop hop-by-hop."""
-    headers = {}
-    for k, v in request_headers.items():
-        if k.lower() not in HOP_BY_HOP and k.lower() != "authorization":
-            headers[k] = v
-    headers["Authorization"] = f"Bearer {api_key}"
+    headers = _strip_hop_by_hop(request_headers)
+    headers[hdrs.AUTHORIZATION] = f"Bearer {api_key}"
     return headers
 
 
@@ -61,31 +139,10 @@ async def _proxy_response(
 ) -> web.StreamResponse:
     """Stream upstream response back to client."""
     # Forward response headers (skip hop-by-hop)
-    resp_headers = {}
-    for k, v in upstream_resp.headers.items():
-        if k.lower() not in HOP_BY_HOP:
-            resp_headers[k] = v
-
-    content_type = upstream_resp.content_type or "application/octet-stream"
+    resp_headers = _strip_hop_by_hop(upstream_resp.headers)
 
-    # Check if response should be streamed (SSE or chunked)
-    is_stream = (
-        "text/event-stream" in content_type
-        or upstream_resp.headers.get("Transfer-Encoding") == "chunked"
-    )
-
-    if is_stream:
-        response = web.StreamResponse(
-            status=upstream_resp.status,
-            headers=resp_headers,
-        )
-        response.content_type = content_type
-        await response.prepare(request)
-        async for chunk in upstream_resp.content.iter_any():
-            await response.write(chunk)
-        await response.write_eof()
-        return response
-    else:
+    # Small bodies of known length go out as one write (headers + body)
+    if upstream_resp.content_length is not None and upstream_resp.content_length < SMALL_BODY_LIMIT:
         body = await upstream_resp.read()
         return web.Response(
             status=upstream_resp.status,
@@ -93,25 +150,54 @@ async def _proxy_response(
             headers=resp_headers,
         )
 
+    response = web.StreamResponse(
+        status=upstream_resp.status,
+        headers=resp_headers,
+    )
+    if upstream_resp.content_length is not None:
+        response.content_length = upstream_resp.content_length
+    await response.prepare(request)
+    try:
+        async for chunk in upstream_resp.content.iter_any():
+            await response.write(chunk)
+        await response.write_eof()
+    except Exception as e:
+        # Too late for an error response: drop the connection so the client
+        # sees a truncated body instead of waiting for the rest
+        if request.transport is not None:
+            request.transport.abort()
+        raise _StreamAborted(response) from e
+    return response
+
+
+async def _record_exhaustion(key_id: int, token_id: int, path: str, method: str):
+    """Deactivate a key that upstream rejected with 402 and log the swap."""
+    await models.add_request_log(path, method, "key_exhausted", key_id, token_id)
+    try:
+        await models.mark_key_exhausted(key_id)
+    except Exception as e:
+        logger.error("Failed to deactivate exhausted key #%d: %s", key_id, e)
+
 
 async def proxy_handler(request: web.Request) -> web.StreamResponse:
     """Universal proxy handler — forwards any request to Pollinations."""
-    # Skip auth for health/status endpoints
     path = request.path
-    if path == "/health":
-        return await health(request)
-    if path == "/status":
-        return await status(request)
 
     # Authenticate
     token, error = await _authenticate(request)
     if error:
         return error
 
-    # Read request body (for POST/PUT/PATCH)
+    # Small bodies are buffered so a 402 can be retried with another key;
+    # large or chunked bodies are streamed upstream and can be sent only once
     body = None
-    if request.method in ("POST", "PUT", "PATCH"):
-        body = await request.read()
+    replayable = True
+    if request.can_read_body:
+        if request.content_length is not None and request.content_length <= RETRY_BODY_LIMIT:
+            body = await request.read()
+        else:
+            body = request.content
+            replayable = False
 
     # Build upstream URL
     upstream_url = UPSTREAM + path
@@ -120,59 +206,71 @@ async def proxy_handler(request: web.Request) -> web.StreamResponse:
 
     # Try keys with rotation on 402
     tried_keys: set[int] = set()
-    for _attempt in range(3):
-        key_data = await models.get_active_key(settings.balance_threshold, exclude_ids=tried_keys)
-        if not key_data:
-            break
-        tried_keys.add(key_data["id"])
-
-        headers = _forward_headers(request.headers, key_data["key"])
-        vless_idx = key_data.get("vless_config_index")
-        connector = _get_connector(vless_idx)
-
-        try:
-            async with aiohttp.ClientSession(connector=connector) as session:
+    exhaustions: list[asyncio.Task] = []
+    try:
+        for _attempt in range(3):
+            key_data = await models.get_active_key(settings.balance_threshold, exclude_ids=tried_keys)
+            if not key_data:
+                break
+            tried_keys.add(key_data.id)
+
+            headers = _forward_headers(request.headers, key_data.key)
+            session = await _get_session(request.app, key_data.vless_config_index)
+
+            try:
                 async with session.request(
                     method=request.method,
                     url=upstream_url,
                     headers=headers,
                     data=body,
-                    timeout=aiohttp.ClientTimeout(total=180),
                 ) as upstream_resp:
                     if upstream_resp.status == 402:
-                        logger.warning("Key #%d exhausted (402), swapping", key_data["id"])
-                        await models.deactivate_key(key_data["id"])
-                        await models.update_key_balance(key_data["id"], 0)
-                        await models.add_request_log(
-                            path, request.method, "key_exhausted",
-                            key_data["id"], token["id"],
-                        )
+                        logger.warning("Key #%d exhausted (402), swapping", key_data.id)
+                        # Recorded in the background while the next key is selected
+                        exhaustions.append(asyncio.create_task(
+                            _record_exhaustion(key_data.id, token.id, path, request.method)
+                        ))
+                        if not replayable:
+                            return json_response(
+                                {"error": "API key exhausted, retry the request"}, status=502,
+                            )
                         continue
 
-                    # Log and return response
+                    # Relay the response, then log it once it was fully delivered
+                    response = await _proxy_response(upstream_resp, request)
                     status_str = "ok" if upstream_resp.status < 400 else f"error_{upstream_resp.status}"
                     await models.add_request_log(
                         path, request.method, status_str,
-                        key_data["id"], token["id"],
+                        key_data.id, token.id,
                     )
-                    return await _proxy_response(upstream_resp, request)
-
-        except Exception as e:
-            logger.error("Proxy error (key #%d): %s", key_data["id"], e)
-            await models.add_request_log(
-                path, request.method, "exception",
-                key_data["id"], token["id"],
-            )
-            return web.json_response({"error": "Upstream connection failed"}, status=502)
-
-    await models.add_request_log(path, request.method, "no_keys", token_id=token["id"])
-    return web.json_response({"error": "No active API keys available"}, status=503)
+                    return response
+
+            except _StreamAborted as e:
+                logger.error("Upstream failed mid-response (key #%d): %s", key_data.id, e.__cause__)
+                await models.add_request_log(
+                    path, request.method, "exception",
+                    key_data.id, token.id,
+                )
+                return e.response
+            except Exception as e:
+                logger.error("Proxy error (key #%d): %s", key_data.id, e)
+                await models.add_request_log(
+                    path, request.method, "exception",
+                    key_data.id, token.id,
+                )
+                return json_response({"error": "Upstream connection failed"}, status=502)
+
+        await models.add_request_log(path, request.method, "no_keys", token_id=token.id)
+        return json_response({"error": "No active API keys available"}, status=503)
+    finally:
+        if exhaustions:
+            await asyncio.gather(*exhaustions)
 
 
 async def health(request: web.Request) -> web.Response:
     """GET /health"""
     keys_stats = await models.get_keys_stats()
-    return web.json_response({
+    return json_response({
         "status": "ok",
         "active_keys": keys_stats["active"],
         "xray": is_xray_running(),
@@ -182,7 +280,7 @@ async def health(request: web.Request) -> web.Response:
 async def status(request: web.Request) -> web.Response:
     """GET /status"""
     keys = await models.get_all_keys()
-    return web.json_response({
+    return json_response({
         "keys": [
             {
                 "masked": k["key"][:6] + "...",
@@ -195,9 +293,31 @@ async def status(request: web.Request) -> web.Response:
     })
 
 
+async def _open_sessions(app: web.Application):
+    """Pre-build upstream sessions for the direct route and every known VLESS."""
+    app[RESOLVER] = DefaultResolver()
+    app[SESSIONS] = {None: _create_session(None, app[RESOLVER])}
+    app[SESSIONS_LOCK] = asyncio.Lock()
+    app[SESSIONS_XRAY_GEN] = get_xray_generation()
+    if is_xray_running():
+        for v in await models.get_all_vless():
+            idx = v["config_index"]
+            app[SESSIONS][idx] = _create_session(idx, app[RESOLVER])
+
+
+async def _close_sessions(app: web.Application):
+    for session in app[SESSIONS].values():
+        await session.close()
+    app[SESSIONS].clear()
+    await app[RESOLVER].close()
+
+
 def create_app() -> web.Application:
     app = web.Application()
-    # Explicit routes for health/status (no auth)
+    app.on_startup.append(_open_sessions)
+    app.on_cleanup.append(_close_sessions)
+    # Explicit routes for health/status (no auth); registered first so the
+    # dispatcher resolves them before reaching the catch-all pattern
     app.router.add_get("/health", health)
     app.router.add_get("/status", status)
     # Catch-all proxy for everything else
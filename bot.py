@@ -14,8 +14,8 @@ from db.database import init_db, close_db
 from db import models
 from api.server import create_app
 from handlers import admin
-from services.vless import restart_xray, stop_xray, is_xray_running, get_xray_tunnel_count
-from services.pollinations import check_key_balance
+from services.vless import SOCKS_BASE_PORT, restart_xray, stop_xray, is_xray_running, get_xray_tunnel_count
+from services.pollinations import check_key_balance, close_sessions
 
 logging.basicConfig(
     level=logging.INFO,
@@ -23,6 +23,9 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Сколько ключей проверяем параллельно
+BALANCE_CHECK_CONCURRENCY = 8
+
 
 async def seed_vless_from_env():
     """Загрузка VLESS конфигов из .env при первом запуске."""
@@ -35,17 +38,17 @@ async def seed_vless_from_env():
         if url not in existing_urls:
             parsed = parse_vless_url(url)
             remark = parsed.get("remark", "") if parsed else ""
-            await models.add_vless(url, remark)
+            await models.add_vless(url, remark, parsed)
             logger.info("VLESS из env добавлен: %s", remark or url[:30])
 
 
 async def setup_xray():
     """Запуск XRAY если есть VLESS конфиги."""
-    urls = await models.get_active_vless_urls()
-    if urls:
-        ok = await restart_xray(urls)
+    configs = await models.get_active_vless_parsed()
+    if configs:
+        ok = await restart_xray(configs)
         if ok:
-            logger.info("XRAY запущен с %d туннелями", len(urls))
+            logger.info("XRAY запущен с %d туннелями", len(configs))
         else:
             logger.warning("Не удалось запустить XRAY")
     else:
@@ -62,30 +65,45 @@ async def balance_check_loop():
             if not keys:
                 continue
 
-            for k in keys:
-                # Определяем порт SOCKS5 для привязанного VLESS
-                vless_idx = k.get("vless_config_index")
-                socks_port = (10801 + vless_idx) if vless_idx is not None and is_xray_running() else None
+            sem = asyncio.Semaphore(BALANCE_CHECK_CONCURRENCY)
+            xray_up = is_xray_running()
+            updates = []
+            to_deactivate = []
+
+            async def probe_one(k):
+                try:
+                    async with sem:
+                        # Определяем порт SOCKS5 для привязанного VLESS
+                        vless_idx = k.get("vless_config_index")
+                        socks_port = (SOCKS_BASE_PORT + vless_idx) if vless_idx is not None and xray_up else None
+                        result = await check_key_balance(k["key"], socks_port)
+                except Exception as e:
+                    # Ошибка одного ключа не должна отменять остальные проверки в TaskGroup
+                    logger.error("Ошибка проверки баланса ключа #%d: %s", k["id"], e)
+                    return
 
-                result = await check_key_balance(k["key"], socks_port)
                 balance = result.get("balance")
-                next_reset = result.get("next_reset_at")
-                await models.update_key_balance(k["id"], balance, next_reset)
+                updates.append((k["id"], balance, result.get("next_reset_at")))
 
                 # Деактивируем ключ если баланс ниже порога
-                if balance is not None and balance < settings.balance_threshold:
-                    if k["is_active"]:
-                        await models.deactivate_key(k["id"])
-                        logger.warning(
-                            "Ключ #%d деактивирован (баланс: %.2f < %.2f)",
-                            k["id"], balance, settings.balance_threshold,
-                        )
+                if balance is not None and balance < settings.balance_threshold and k["is_active"]:
+                    to_deactivate.append(k["id"])
+                    logger.warning(
+                        "Ключ #%d деактивирован (баланс: %.2f < %.2f)",
+                        k["id"], balance, settings.balance_threshold,
+                    )
+
+            async with asyncio.TaskGroup() as tg:
+                for k in keys:
+                    tg.create_task(probe_one(k))
+
+            await models.update_key_balances_bulk(updates, to_deactivate)
 
             # Проверяем нужно ли перезапустить XRAY (новые VLESS конфиги или XRAY упал)
-            urls = await models.get_active_vless_urls()
-            if urls and (not is_xray_running() or len(urls) != get_xray_tunnel_count()):
-                await restart_xray(urls)
-                logger.info("XRAY перезапущен с %d туннелями", len(urls))
+            configs = await models.get_active_vless_parsed()
+            if configs and (not is_xray_running() or len(configs) != get_xray_tunnel_count()):
+                await restart_xray(configs)
+                logger.info("XRAY перезапущен с %d туннелями", len(configs))
 
         except asyncio.CancelledError:
             break
@@ -114,6 +132,7 @@ async def main():
 
     # Инициализация БД
     await init_db()
+    models.start_log_flusher()
 
     # Загрузка VLESS из .env
     await seed_vless_from_env()
@@ -139,12 +158,21 @@ async def main():
             await balance_task
         except asyncio.CancelledError:
             pass
+        # Только после остановки проверки балансов, иначе она откроет новые сессии
+        await close_sessions()
         await stop_xray()
         await api_runner.cleanup()
+        await models.stop_log_flusher()
         await close_db()
         await bot.session.close()
         logger.info("Сервис остановлен.")
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    try:
+        import uvloop
+    except ImportError:
+        asyncio.run(main())
+    else:
+        # libuv-цикл событий быстрее стандартного для сетевой нагрузки
+        uvloop.run(main())
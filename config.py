@@ -1,4 +1,5 @@
 from dataclasses import dataclass, field
+from functools import lru_cache
 from os import getenv
 
 from dotenv import load_dotenv
@@ -6,20 +7,27 @@ from dotenv import load_dotenv
 load_dotenv()
 
 
-@dataclass
+@lru_cache(maxsize=None)
+def _csv(value: str) -> tuple[str, ...]:
+    return tuple(x.strip() for x in value.split(",") if x.strip())
+
+
+@lru_cache(maxsize=None)
+def _csv_int(value: str) -> tuple[int, ...]:
+    return tuple(int(x) for x in _csv(value))
+
+
+@dataclass(frozen=True, slots=True)
 class Settings:
     bot_token: str = field(default_factory=lambda: getenv("SERVICE_BOT_TOKEN", ""))
-    admin_ids: list[int] = field(default_factory=lambda: [
-        int(x.strip()) for x in getenv("ADMIN_IDS", "").split(",") if x.strip()
-    ])
+    admin_ids: frozenset[int] = field(default_factory=lambda: frozenset(_csv_int(getenv("ADMIN_IDS", ""))))
     api_host: str = field(default_factory=lambda: getenv("API_HOST", "0.0.0.0"))
     api_port: int = field(default_factory=lambda: int(getenv("API_PORT", "8080")))
     db_path: str = field(default_factory=lambda: getenv("DB_PATH", "service.db"))
-    vless_configs: list[str] = field(default_factory=lambda: [
-        u.strip() for u in getenv("VLESS_CONFIGS", "").split(",") if u.strip()
-    ])
+    vless_configs: tuple[str, ...] = field(default_factory=lambda: _csv(getenv("VLESS_CONFIGS", "")))
     balance_threshold: float = field(default_factory=lambda: float(getenv("BALANCE_THRESHOLD", "0.1")))
     balance_check_interval: int = field(default_factory=lambda: int(getenv("BALANCE_CHECK_INTERVAL", "10")))
+    xray_log_path: str = field(default_factory=lambda: getenv("XRAY_LOG_PATH", ""))
 
     def __post_init__(self):
         if not self.bot_token:
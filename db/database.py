@@ -1,17 +1,93 @@
+import asyncio
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+
 import aiosqlite
 
 from config import settings
 
-_connection: aiosqlite.Connection | None = None
+READ_POOL_SIZE = 4
+# Per-connection prepared statement cache (sqlite3 default is 128)
+CACHED_STATEMENTS = 512
+
+# One writer connection; SELECTs go through a small pool of read-only
+# connections so they don't queue behind writes (WAL allows concurrent readers)
+_writer: aiosqlite.Connection | None = None
+_readers: asyncio.Queue | None = None
+_reader_conns: list[aiosqlite.Connection] = []
+_readers_lock = asyncio.Lock()
+# Serializes writes on the autocommit writer so transactions don't interleave
+_write_lock = asyncio.Lock()
+
+
+async def _connect(**kwargs) -> aiosqlite.Connection:
+    conn = await aiosqlite.connect(
+        settings.db_path, cached_statements=CACHED_STATEMENTS, isolation_level=None, **kwargs,
+    )
+    conn.row_factory = aiosqlite.Row
+    await conn.execute("PRAGMA temp_store=MEMORY")
+    await conn.execute("PRAGMA mmap_size=268435456")
+    await conn.execute("PRAGMA cache_size=-20000")
+    return conn
 
 
 async def get_db() -> aiosqlite.Connection:
-    global _connection
-    if _connection is None:
-        _connection = await aiosqlite.connect(settings.db_path)
-        _connection.row_factory = aiosqlite.Row
-        await _connection.execute("PRAGMA journal_mode=WAL")
-    return _connection
+    """Return the shared writer connection (autocommit; use transaction() to group writes)."""
+    global _writer
+    if _writer is None:
+        _writer = await _connect()
+        await _writer.execute("PRAGMA journal_mode=WAL")
+        await _writer.execute("PRAGMA synchronous=NORMAL")
+    return _writer
+
+
+async def _open_readers():
+    global _readers
+    async with _readers_lock:
+        if _readers is not None:
+            return
+        # Make sure the database exists in WAL mode before readers attach
+        await get_db()
+        readers = asyncio.Queue()
+        for _ in range(READ_POOL_SIZE):
+            conn = await _connect()
+            await conn.execute("PRAGMA query_only=1")
+            _reader_conns.append(conn)
+            readers.put_nowait(conn)
+        _readers = readers
+
+
+async def execute_write(sql: str, parameters=()) -> aiosqlite.Cursor:
+    """Run a single autocommitted write statement."""
+    db = await get_db()
+    async with _write_lock:
+        return await db.execute(sql, parameters)
+
+
+@asynccontextmanager
+async def transaction() -> AsyncIterator[aiosqlite.Connection]:
+    """Group several writes into one BEGIN ... COMMIT on the writer."""
+    db = await get_db()
+    async with _write_lock:
+        await db.execute("BEGIN")
+        try:
+            yield db
+        except BaseException:
+            await db.rollback()
+            raise
+        await db.commit()
+
+
+@asynccontextmanager
+async def get_reader() -> AsyncIterator[aiosqlite.Connection]:
+    """Borrow a read-only connection from the pool."""
+    if _readers is None:
+        await _open_readers()
+    conn = await _readers.get()
+    try:
+        yield conn
+    finally:
+        _readers.put_nowait(conn)
 
 
 async def init_db():
@@ -41,9 +117,14 @@ async def init_db():
             remark TEXT DEFAULT '',
             is_active INTEGER DEFAULT 1,
             config_index INTEGER NOT NULL DEFAULT 0,
+            parsed_json TEXT DEFAULT NULL,
             created_at TEXT DEFAULT (datetime('now'))
         )
     """)
+    # Older databases predate parsed_json
+    cursor = await db.execute("PRAGMA table_info(vless_configs)")
+    if "parsed_json" not in {row["name"] for row in await cursor.fetchall()}:
+        await db.execute("ALTER TABLE vless_configs ADD COLUMN parsed_json TEXT DEFAULT NULL")
 
     # Service tokens for Bearer auth
     await db.execute("""
@@ -82,11 +163,28 @@ async def init_db():
         )
     """)
 
+    # Indexes for hot lookups and daily stats
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_tokens_active_token ON service_tokens(token) WHERE is_active = 1"
+    )
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_keys_active_bal ON api_keys(is_active, pollen_balance DESC)"
+    )
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_keys_vless ON api_keys(vless_id)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_log_created ON request_log(created_at)")
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_log_token_created ON request_log(token_id, created_at)"
+    )
+
     await db.commit()
 
 
 async def close_db():
-    global _connection
-    if _connection is not None:
-        await _connection.close()
-        _connection = None
+    global _writer, _readers
+    for conn in _reader_conns:
+        await conn.close()
+    _reader_conns.clear()
+    _readers = None
+    if _writer is not None:
+        await _writer.close()
+        _writer = None
@@ -1,248 +1,419 @@
-from db.database import get_db
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import NamedTuple
+
+import orjson
+
+from db.database import execute_write, get_reader, transaction
+from services.vless import parse_vless_url
+
+logger = logging.getLogger(__name__)
+
+# Hot-path statements kept as constants so every call hits the statement cache
+_SQL_GET_TOKEN = (
+    "SELECT id, token, name, is_active FROM service_tokens WHERE token = ? AND is_active = 1"
+)
+_SQL_INSERT_LOG = (
+    "INSERT INTO request_log (path, method, status, key_id, token_id) VALUES (?, ?, ?, ?, ?)"
+)
+_SQL_GET_ACTIVE_KEY = """SELECT k.id, k.key, k.vless_id, k.is_active, k.pollen_balance,
+                 v.config_index as vless_config_index
+          FROM api_keys k LEFT JOIN vless_configs v ON k.vless_id = v.id
+          WHERE k.is_active = 1
+          AND (k.pollen_balance IS NULL OR k.pollen_balance >= ?)
+          {exclude}
+          ORDER BY k.pollen_balance DESC
+          LIMIT 1"""
+_SQL_GET_ACTIVE_KEY_ANY = _SQL_GET_ACTIVE_KEY.format(exclude="")
+
+
+class ActiveKey(NamedTuple):
+    """Key picked for proxying — only the columns the request path reads."""
+    id: int
+    key: str
+    vless_id: int | None
+    is_active: int
+    pollen_balance: float | None
+    vless_config_index: int | None
+
+
+class Token(NamedTuple):
+    id: int
+    token: str
+    name: str
+    is_active: int
+
+
+# Token lookups (including misses) cached for a short TTL, LRU-bounded
+_TOKEN_TTL = 60
+_TOKEN_CACHE_SIZE = 10_000
+_token_cache: OrderedDict[str, tuple[Token | None, float]] = OrderedDict()
+_token_cache_version = 0
+
+# Best active key (balance_threshold, key), reset by every key mutation
+_active_key_cache: tuple[float, ActiveKey] | None = None
+_cache_version = 0
+
+
+def _invalidate_active_key_cache():
+    global _active_key_cache, _cache_version
+    _active_key_cache = None
+    _cache_version += 1
+
+
+def _invalidate_token_cache(token: str | None):
+    global _token_cache_version
+    _token_cache.pop(token, None)
+    _token_cache_version += 1
 
 
 # --- API Keys ---
 
 async def get_all_keys() -> list[dict]:
-    db = await get_db()
-    cursor = await db.execute(
-        """SELECT k.*, v.remark as vless_remark, v.config_index as vless_config_index
-           FROM api_keys k LEFT JOIN vless_configs v ON k.vless_id = v.id
-           ORDER BY k.key_index"""
-    )
-    rows = await cursor.fetchall()
+    async with get_reader() as db:
+        cursor = await db.execute(
+            """SELECT k.*, v.remark as vless_remark, v.config_index as vless_config_index
+               FROM api_keys k LEFT JOIN vless_configs v ON k.vless_id = v.id
+               ORDER BY k.key_index"""
+        )
+        rows = await cursor.fetchall()
     return [dict(r) for r in rows]
 
 
-async def get_active_key(balance_threshold: float = 0.1, exclude_ids: set | None = None) -> dict | None:
+async def get_active_key(balance_threshold: float = 0.1, exclude_ids: set | None = None) -> ActiveKey | None:
     """Get the best active key with its bound VLESS config_index."""
-    db = await get_db()
-    cursor = await db.execute(
-        """SELECT k.*, v.config_index as vless_config_index
-           FROM api_keys k LEFT JOIN vless_configs v ON k.vless_id = v.id
-           WHERE k.is_active = 1
-           AND (k.pollen_balance IS NULL OR k.pollen_balance >= ?)
-           ORDER BY k.pollen_balance DESC""",
-        (balance_threshold,),
-    )
-    rows = await cursor.fetchall()
-    for row in rows:
-        if exclude_ids and row["id"] in exclude_ids:
-            continue
-        return dict(row)
-    return None
+    global _active_key_cache
+    if not exclude_ids and _active_key_cache is not None and _active_key_cache[0] == balance_threshold:
+        return _active_key_cache[1]
+
+    version = _cache_version
+    exclude = tuple(exclude_ids or ())
+    if exclude:
+        sql = _SQL_GET_ACTIVE_KEY.format(exclude=f"AND k.id NOT IN ({','.join('?' * len(exclude))})")
+    else:
+        sql = _SQL_GET_ACTIVE_KEY_ANY
+    async with get_reader() as db:
+        cursor = await db.execute(sql, (balance_threshold, *exclude))
+        row = await cursor.fetchone()
+    key = ActiveKey(*row) if row else None
+    # Skip caching if a key mutation landed while the query was in flight
+    if key and not exclude and version == _cache_version:
+        _active_key_cache = (balance_threshold, key)
+    return key
 
 
 async def get_key_by_id(key_id: int) -> dict | None:
-    db = await get_db()
-    cursor = await db.execute("SELECT * FROM api_keys WHERE id = ?", (key_id,))
-    row = await cursor.fetchone()
+    async with get_reader() as db:
+        cursor = await db.execute("SELECT * FROM api_keys WHERE id = ?", (key_id,))
+        row = await cursor.fetchone()
     return dict(row) if row else None
 
 
 async def add_api_key(key: str, vless_id: int | None = None) -> int:
-    db = await get_db()
-    cursor = await db.execute("SELECT COALESCE(MAX(key_index), -1) + 1 FROM api_keys")
-    row = await cursor.fetchone()
-    next_index = row[0]
-    await db.execute(
-        "INSERT OR IGNORE INTO api_keys (key, key_index, vless_id) VALUES (?, ?, ?)",
-        (key, next_index, vless_id),
-    )
-    await db.commit()
-    return next_index
+    """Insert a key (no-op if it already exists) and return its row id."""
+    async with transaction() as db:
+        cursor = await db.execute("SELECT COALESCE(MAX(key_index), -1) + 1 FROM api_keys")
+        row = await cursor.fetchone()
+        next_index = row[0]
+        cursor = await db.execute(
+            "INSERT OR IGNORE INTO api_keys (key, key_index, vless_id) VALUES (?, ?, ?)",
+            (key, next_index, vless_id),
+        )
+        if cursor.rowcount == 1:
+            key_id = cursor.lastrowid
+        else:
+            cursor = await db.execute("SELECT id FROM api_keys WHERE key = ?", (key,))
+            key_id = (await cursor.fetchone())[0]
+    _invalidate_active_key_cache()
+    return key_id
 
 
 async def delete_api_key(key_id: int):
-    db = await get_db()
-    await db.execute("DELETE FROM api_keys WHERE id = ?", (key_id,))
-    await db.commit()
+    await execute_write("DELETE FROM api_keys WHERE id = ?", (key_id,))
+    _invalidate_active_key_cache()
 
 
 async def update_key_balance(key_id: int, balance: float | None, next_reset_at: str | None = None):
-    db = await get_db()
-    await db.execute(
+    await execute_write(
         """UPDATE api_keys SET pollen_balance = ?, next_reset_at = ?,
            balance_checked_at = datetime('now') WHERE id = ?""",
         (balance, next_reset_at, key_id),
     )
-    await db.commit()
+    _invalidate_active_key_cache()
+
+
+async def update_key_balances_bulk(
+    updates: list[tuple[int, float | None, str | None]], deactivate_ids: list[int] | None = None,
+):
+    """Apply (key_id, balance, next_reset_at) updates and deactivations in one commit."""
+    async with transaction() as db:
+        await db.executemany(
+            """UPDATE api_keys SET pollen_balance = ?, next_reset_at = ?,
+               balance_checked_at = datetime('now') WHERE id = ?""",
+            [(balance, next_reset_at, key_id) for key_id, balance, next_reset_at in updates],
+        )
+        await db.executemany(
+            "UPDATE api_keys SET is_active = 0 WHERE id = ?",
+            [(key_id,) for key_id in deactivate_ids or ()],
+        )
+    _invalidate_active_key_cache()
 
 
 async def bind_key_to_vless(key_id: int, vless_id: int | None):
-    db = await get_db()
-    await db.execute("UPDATE api_keys SET vless_id = ? WHERE id = ?", (vless_id, key_id))
-    await db.commit()
+    await execute_write("UPDATE api_keys SET vless_id = ? WHERE id = ?", (vless_id, key_id))
+    _invalidate_active_key_cache()
 
 
 async def deactivate_key(key_id: int):
-    db = await get_db()
-    await db.execute("UPDATE api_keys SET is_active = 0 WHERE id = ?", (key_id,))
-    await db.commit()
+    await execute_write("UPDATE api_keys SET is_active = 0 WHERE id = ?", (key_id,))
+    _invalidate_active_key_cache()
+
+
+async def mark_key_exhausted(key_id: int):
+    """Deactivate a key and zero its balance in one statement (upstream returned 402)."""
+    await execute_write(
+        """UPDATE api_keys SET is_active = 0, pollen_balance = 0, next_reset_at = NULL,
+           balance_checked_at = datetime('now') WHERE id = ?""",
+        (key_id,),
+    )
+    _invalidate_active_key_cache()
 
 
 async def reactivate_keys_after_reset():
     """Re-activate all keys (called after pollen reset)."""
-    db = await get_db()
-    await db.execute("UPDATE api_keys SET is_active = 1")
-    await db.commit()
+    await execute_write("UPDATE api_keys SET is_active = 1")
+    _invalidate_active_key_cache()
 
 
 async def get_keys_stats() -> dict:
-    db = await get_db()
-    cursor = await db.execute("SELECT COUNT(*) FROM api_keys")
-    total = (await cursor.fetchone())[0]
-    cursor = await db.execute("SELECT COUNT(*) FROM api_keys WHERE is_active = 1")
-    active = (await cursor.fetchone())[0]
-    cursor = await db.execute(
-        "SELECT COALESCE(SUM(pollen_balance), 0) FROM api_keys WHERE pollen_balance IS NOT NULL"
-    )
-    total_balance = (await cursor.fetchone())[0]
+    async with get_reader() as db:
+        cursor = await db.execute(
+            """SELECT COUNT(*), COALESCE(SUM(is_active = 1), 0), COALESCE(SUM(pollen_balance), 0)
+               FROM api_keys"""
+        )
+        total, active, total_balance = await cursor.fetchone()
     return {"total": total, "active": active, "total_balance": round(total_balance, 2)}
 
 
 # --- VLESS Configs ---
 
 async def get_all_vless() -> list[dict]:
-    db = await get_db()
-    cursor = await db.execute("SELECT * FROM vless_configs ORDER BY config_index")
-    rows = await cursor.fetchall()
+    async with get_reader() as db:
+        cursor = await db.execute("SELECT * FROM vless_configs ORDER BY config_index")
+        rows = await cursor.fetchall()
     return [dict(r) for r in rows]
 
 
-async def get_active_vless_urls() -> list[str]:
-    db = await get_db()
-    cursor = await db.execute(
-        "SELECT url FROM vless_configs WHERE is_active = 1 ORDER BY config_index"
-    )
-    rows = await cursor.fetchall()
-    return [r["url"] for r in rows]
-
-
-async def add_vless(url: str, remark: str = "") -> int:
-    db = await get_db()
-    cursor = await db.execute("SELECT COALESCE(MAX(config_index), -1) + 1 FROM vless_configs")
-    row = await cursor.fetchone()
-    next_index = row[0]
-    await db.execute(
-        "INSERT OR IGNORE INTO vless_configs (url, remark, config_index) VALUES (?, ?, ?)",
-        (url, remark, next_index),
-    )
-    await db.commit()
+async def get_active_vless_parsed() -> list[dict]:
+    """Parsed configs of active VLESS rows, ready for generate_xray_config."""
+    async with get_reader() as db:
+        cursor = await db.execute(
+            "SELECT url, parsed_json, config_index FROM vless_configs "
+            "WHERE is_active = 1 ORDER BY config_index"
+        )
+        rows = await cursor.fetchall()
+    configs = []
+    for r in rows:
+        # Rows added before parsed_json existed are parsed on the fly
+        parsed = orjson.loads(r["parsed_json"]) if r["parsed_json"] else parse_vless_url(r["url"])
+        if parsed:
+            parsed["config_index"] = r["config_index"]
+            configs.append(parsed)
+    return configs
+
+
+async def add_vless(url: str, remark: str = "", parsed: dict | None = None) -> int:
+    """Insert a VLESS config (no-op if the URL exists) and return its config_index."""
+    async with transaction() as db:
+        cursor = await db.execute("SELECT COALESCE(MAX(config_index), -1) + 1 FROM vless_configs")
+        row = await cursor.fetchone()
+        next_index = row[0]
+        cursor = await db.execute(
+            "INSERT OR IGNORE INTO vless_configs (url, remark, config_index, parsed_json) "
+            "VALUES (?, ?, ?, ?)",
+            (url, remark, next_index, orjson.dumps(parsed).decode() if parsed else None),
+        )
+        if cursor.rowcount != 1:
+            cursor = await db.execute("SELECT config_index FROM vless_configs WHERE url = ?", (url,))
+            next_index = (await cursor.fetchone())[0]
     return next_index
 
 
-async def delete_vless(vless_id: int):
-    db = await get_db()
-    # Unbind any keys from this vless
-    await db.execute("UPDATE api_keys SET vless_id = NULL WHERE vless_id = ?", (vless_id,))
-    await db.execute("DELETE FROM vless_configs WHERE id = ?", (vless_id,))
-    await db.commit()
+async def delete_vless(vless_id: int) -> int | None:
+    """Delete a VLESS config and return its config_index (None if it didn't exist)."""
+    async with transaction() as db:
+        cursor = await db.execute("SELECT config_index FROM vless_configs WHERE id = ?", (vless_id,))
+        row = await cursor.fetchone()
+        # Unbind any keys from this vless
+        await db.execute("UPDATE api_keys SET vless_id = NULL WHERE vless_id = ?", (vless_id,))
+        await db.execute("DELETE FROM vless_configs WHERE id = ?", (vless_id,))
+    _invalidate_active_key_cache()
+    return row[0] if row else None
 
 
 async def get_vless_stats() -> dict:
-    db = await get_db()
-    cursor = await db.execute("SELECT COUNT(*) FROM vless_configs")
-    total = (await cursor.fetchone())[0]
-    cursor = await db.execute("SELECT COUNT(*) FROM vless_configs WHERE is_active = 1")
-    active = (await cursor.fetchone())[0]
+    async with get_reader() as db:
+        cursor = await db.execute("SELECT COUNT(*), COALESCE(SUM(is_active = 1), 0) FROM vless_configs")
+        total, active = await cursor.fetchone()
     return {"total": total, "active": active}
 
 
 # --- Service Tokens ---
 
 async def get_all_tokens() -> list[dict]:
-    db = await get_db()
-    cursor = await db.execute("SELECT * FROM service_tokens ORDER BY id")
-    rows = await cursor.fetchall()
+    async with get_reader() as db:
+        cursor = await db.execute("SELECT * FROM service_tokens ORDER BY id")
+        rows = await cursor.fetchall()
     return [dict(r) for r in rows]
 
 
-async def get_token_by_value(token: str) -> dict | None:
-    db = await get_db()
-    cursor = await db.execute(
-        "SELECT * FROM service_tokens WHERE token = ? AND is_active = 1", (token,)
-    )
-    row = await cursor.fetchone()
-    return dict(row) if row else None
+async def get_token_by_value(token: str) -> Token | None:
+    cached = _token_cache.get(token)
+    if cached is not None and cached[1] > time.monotonic():
+        _token_cache.move_to_end(token)
+        return cached[0]
+
+    version = _token_cache_version
+    async with get_reader() as db:
+        cursor = await db.execute(_SQL_GET_TOKEN, (token,))
+        row = await cursor.fetchone()
+    result = Token(*row) if row else None
+
+    # Skip caching if a token mutation landed while the query was in flight
+    if version != _token_cache_version:
+        return result
+    _token_cache[token] = (result, time.monotonic() + _TOKEN_TTL)
+    _token_cache.move_to_end(token)
+    if len(_token_cache) > _TOKEN_CACHE_SIZE:
+        _token_cache.popitem(last=False)
+    return result
+
+
+async def _get_token_value(token_id: int) -> str | None:
+    async with get_reader() as db:
+        cursor = await db.execute("SELECT token FROM service_tokens WHERE id = ?", (token_id,))
+        row = await cursor.fetchone()
+    return row["token"] if row else None
 
 
 async def create_token(token: str, name: str = "") -> int:
-    db = await get_db()
-    cursor = await db.execute(
+    cursor = await execute_write(
         "INSERT INTO service_tokens (token, name) VALUES (?, ?)", (token, name),
     )
-    await db.commit()
+    _invalidate_token_cache(token)
     return cursor.lastrowid
 
 
 async def revoke_token(token_id: int):
-    db = await get_db()
-    await db.execute("UPDATE service_tokens SET is_active = 0 WHERE id = ?", (token_id,))
-    await db.commit()
+    value = await _get_token_value(token_id)
+    await execute_write("UPDATE service_tokens SET is_active = 0 WHERE id = ?", (token_id,))
+    # Drop the cached lookup so revocation applies immediately
+    _invalidate_token_cache(value)
 
 
 async def delete_token(token_id: int):
-    db = await get_db()
-    await db.execute("DELETE FROM service_tokens WHERE id = ?", (token_id,))
-    await db.commit()
+    value = await _get_token_value(token_id)
+    await execute_write("DELETE FROM service_tokens WHERE id = ?", (token_id,))
+    _invalidate_token_cache(value)
 
 
 # --- Request Log ---
 
+# Log rows are queued and written in batches by a background flusher
+_LOG_BATCH_SIZE = 256
+_LOG_FLUSH_INTERVAL = 0.1
+_log_queue: asyncio.Queue = asyncio.Queue()
+_log_flusher_task: asyncio.Task | None = None
+
+
 async def add_request_log(
     path: str, method: str, status: str,
     key_id: int | None = None, token_id: int | None = None,
 ):
-    db = await get_db()
-    await db.execute(
-        "INSERT INTO request_log (path, method, status, key_id, token_id) VALUES (?, ?, ?, ?, ?)",
-        (path, method, status, key_id, token_id),
-    )
-    await db.commit()
+    _log_queue.put_nowait((path, method, status, key_id, token_id))
+
+
+async def _write_request_log(rows: list[tuple]):
+    async with transaction() as db:
+        await db.executemany(_SQL_INSERT_LOG, rows)
+
+
+async def _log_flusher():
+    """Drain the log queue, one transaction per batch. A None item stops the loop."""
+    while True:
+        rows = [await _log_queue.get()]
+        if _log_queue.qsize() < _LOG_BATCH_SIZE - 1:
+            # Let a partial batch fill up; a full one is written right away
+            await asyncio.sleep(_LOG_FLUSH_INTERVAL)
+        while len(rows) < _LOG_BATCH_SIZE and not _log_queue.empty():
+            rows.append(_log_queue.get_nowait())
+
+        stop = None in rows
+        rows = [r for r in rows if r is not None]
+        if rows:
+            try:
+                await _write_request_log(rows)
+            except Exception as e:
+                logger.error("Failed to write %d request log rows: %s", len(rows), e)
+        if stop:
+            return
+
+
+def start_log_flusher():
+    global _log_flusher_task
+    if _log_flusher_task is None:
+        _log_flusher_task = asyncio.create_task(_log_flusher())
+
+
+async def stop_log_flusher():
+    """Flush everything queued so far and stop the background writer."""
+    global _log_flusher_task
+    if _log_flusher_task is None:
+        return
+    _log_queue.put_nowait(None)
+    await _log_flusher_task
+    _log_flusher_task = None
 
 
 async def get_stats() -> dict:
-    db = await get_db()
-    cursor = await db.execute(
-        "SELECT COUNT(*) FROM request_log WHERE created_at >= date('now')"
-    )
-    today = (await cursor.fetchone())[0]
-    cursor = await db.execute("SELECT COUNT(*) FROM request_log")
-    total = (await cursor.fetchone())[0]
-    cursor = await db.execute(
-        "SELECT COUNT(*) FROM request_log WHERE status = 'ok' AND created_at >= date('now')"
-    )
-    success_today = (await cursor.fetchone())[0]
+    async with get_reader() as db:
+        cursor = await db.execute(
+            """SELECT COUNT(*),
+                      COALESCE(SUM(created_at >= date('now')), 0),
+                      COALESCE(SUM(status = 'ok' AND created_at >= date('now')), 0)
+               FROM request_log"""
+        )
+        total, today, success_today = await cursor.fetchone()
     return {"today": today, "total": total, "success_today": success_today}
 
 
 async def get_token_stats(token_id: int) -> dict:
     """Stats for a specific token."""
-    db = await get_db()
-    cursor = await db.execute(
-        "SELECT COUNT(*) FROM request_log WHERE token_id = ? AND created_at >= date('now')",
-        (token_id,),
-    )
-    today = (await cursor.fetchone())[0]
-    cursor = await db.execute(
-        "SELECT COUNT(*) FROM request_log WHERE token_id = ?",
-        (token_id,),
-    )
-    total = (await cursor.fetchone())[0]
-    cursor = await db.execute(
-        "SELECT COUNT(*) FROM request_log WHERE token_id = ? AND status = 'ok' AND created_at >= date('now')",
-        (token_id,),
-    )
-    success_today = (await cursor.fetchone())[0]
+    async with get_reader() as db:
+        cursor = await db.execute(
+            """SELECT COUNT(*),
+                      COALESCE(SUM(created_at >= date('now')), 0),
+                      COALESCE(SUM(status = 'ok' AND created_at >= date('now')), 0)
+               FROM request_log WHERE token_id = ?""",
+            (token_id,),
+        )
+        total, today, success_today = await cursor.fetchone()
     return {"today": today, "total": total, "success_today": success_today}
 
 
 async def get_all_tokens_stats() -> list[dict]:
     """Get stats per token for display."""
-    tokens = await get_all_tokens()
-    result = []
-    for t in tokens:
-        stats = await get_token_stats(t["id"])
-        result.append({**t, **stats})
-    return result
+    async with get_reader() as db:
+        cursor = await db.execute(
+            """SELECT t.*,
+                      COALESCE(SUM(l.created_at >= date('now')), 0) as today,
+                      COUNT(l.id) as total,
+                      COALESCE(SUM(l.status = 'ok' AND l.created_at >= date('now')), 0) as success_today
+               FROM service_tokens t LEFT JOIN request_log l ON l.token_id = t.id
+               GROUP BY t.id
+               ORDER BY t.id"""
+        )
+        rows = await cursor.fetchall()
+    return [dict(r) for r in rows]
@@ -1,22 +1,43 @@
 """Telegram бот — админ-панель: ключи, VLESS, токены, статистика."""
 
+import asyncio
 import logging
 import secrets
 
 from aiogram import Router, F
 from aiogram.filters import Command
+from aiogram.filters.callback_data import CallbackData
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import Message, CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup
+from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 from config import settings
 from db import models
 from services.pollinations import check_key_balance, validate_key
-from services.vless import parse_vless_url, is_xray_running, restart_xray
+from services.vless import (
+    SOCKS_BASE_PORT,
+    add_outbound,
+    get_xray_socks_port,
+    is_xray_running,
+    parse_vless_url,
+    remove_outbound,
+    restart_xray,
+    stop_xray,
+)
 
 logger = logging.getLogger(__name__)
 
 router = Router()
+# Вся админка доступна только админам — отсекаем остальных до вызова хендлеров
+router.message.filter(F.from_user.id.in_(settings.admin_ids))
+router.callback_query.filter(F.from_user.id.in_(settings.admin_ids))
+
+# Сколько ключей проверяем параллельно при ручном обновлении балансов
+REFRESH_CONCURRENCY = 16
+
+# Идущее ручное обновление балансов — повторные нажатия ждут его, а не запускают новое
+_refresh_inflight: asyncio.Task | None = None
 
 
 class AddKey(StatesGroup):
@@ -32,29 +53,61 @@ class CreateToken(StatesGroup):
     waiting_name = State()
 
 
-def is_admin(user_id: int) -> bool:
-    return user_id in settings.admin_ids
+# Типизированные callback_data: aiogram сам разбирает и фильтрует их по префиксу
+class KeyCb(CallbackData, prefix="key"):
+    action: str
+    id: int | None = None
+    vless_id: int | None = None
 
 
-def main_menu_kb() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📊 Статистика", callback_data="stats")],
-        [InlineKeyboardButton(text="🔑 Ключи", callback_data="keys")],
-        [InlineKeyboardButton(text="🌐 VLESS", callback_data="vless")],
-        [InlineKeyboardButton(text="🔐 Токены", callback_data="tokens")],
-    ])
+class VlessCb(CallbackData, prefix="vless"):
+    action: str
+    id: int
+
+
+class TokenCb(CallbackData, prefix="token"):
+    action: str
+    id: int
+
+
+# Статичные клавиатуры собираем один раз — aiogram сериализует их при каждой отправке
+MAIN_MENU_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="📊 Статистика", callback_data="stats")],
+    [InlineKeyboardButton(text="🔑 Ключи", callback_data="keys")],
+    [InlineKeyboardButton(text="🌐 VLESS", callback_data="vless")],
+    [InlineKeyboardButton(text="🔐 Токены", callback_data="tokens")],
+])
+
+CANCEL_KEYS_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="❌ Отмена", callback_data="keys")],
+])
+
+CANCEL_VLESS_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="❌ Отмена", callback_data="vless")],
+])
+
+CANCEL_TOKENS_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="❌ Отмена", callback_data="tokens")],
+])
+
+
+# Кнопки динамических списков собираем из своих же данных — pydantic-валидация не нужна
+_button = InlineKeyboardButton.model_construct
+
+
+def _mask(s: str) -> str:
+    """Скрывает середину ключа/токена: первые 8 и последние 4 символа."""
+    return f"{s[:8]}...{s[-4:]}"
 
 
 # --- /start ---
 
 @router.message(Command("start"))
 async def cmd_start(message: Message, state: FSMContext):
-    if not is_admin(message.from_user.id):
-        return
     await state.clear()
     await message.answer(
         "🛠 <b>Service Pollinations Key Swap</b>\n\nВыберите раздел:",
-        reply_markup=main_menu_kb(),
+        reply_markup=MAIN_MENU_KB,
     )
 
 
@@ -62,11 +115,13 @@ async def cmd_start(message: Message, state: FSMContext):
 
 @router.callback_query(F.data == "stats")
 async def cb_stats(callback: CallbackQuery):
-    if not is_admin(callback.from_user.id):
-        return
-    keys_stats = await models.get_keys_stats()
-    vless_stats = await models.get_vless_stats()
-    req_stats = await models.get_stats()
+    # Запросы независимы — читаем параллельно через пул читателей
+    keys_stats, vless_stats, req_stats, tokens_stats = await asyncio.gather(
+        models.get_keys_stats(),
+        models.get_vless_stats(),
+        models.get_stats(),
+        models.get_all_tokens_stats(),
+    )
 
     text = (
         "📊 <b>Общая статистика</b>\n\n"
@@ -79,7 +134,6 @@ async def cb_stats(callback: CallbackQuery):
     )
 
     # Статистика по токенам
-    tokens_stats = await models.get_all_tokens_stats()
     if tokens_stats:
         text += "\n\n<b>По токенам:</b>"
         for t in tokens_stats:
@@ -99,59 +153,43 @@ async def cb_stats(callback: CallbackQuery):
 
 @router.callback_query(F.data == "keys")
 async def cb_keys(callback: CallbackQuery):
-    if not is_admin(callback.from_user.id):
-        return
     keys = await models.get_all_keys()
 
-    if not keys:
-        text = "🔑 <b>Ключи</b>\n\nНет ключей."
-    else:
-        lines = ["🔑 <b>Ключи</b>\n"]
-        for k in keys:
-            status = "✅" if k["is_active"] else "❌"
-            balance = f"{k['pollen_balance']:.2f}" if k["pollen_balance"] is not None else "?"
-            masked = k["key"][:8] + "..." + k["key"][-4:]
-            vless_info = f" → {k['vless_remark']}" if k.get("vless_remark") else " (без VLESS)"
-            lines.append(f"{status} <code>{masked}</code> — {balance} p{vless_info}")
-        text = "\n".join(lines)
-
-    buttons = [
-        [InlineKeyboardButton(text="➕ Добавить ключ", callback_data="key_add")],
-        [InlineKeyboardButton(text="🔄 Обновить балансы", callback_data="key_refresh_all")],
-    ]
+    # Текст и кнопки собираем за один проход по ключам
+    lines = ["🔑 <b>Ключи</b>\n"]
+    builder = InlineKeyboardBuilder()
+    builder.row(_button(text="➕ Добавить ключ", callback_data="key_add"))
+    builder.row(_button(text="🔄 Обновить балансы", callback_data="key_refresh_all"))
     for k in keys:
-        masked = k["key"][:8] + "..."
-        row = [
-            InlineKeyboardButton(text=f"🔗 {masked}", callback_data=f"key_bind_{k['id']}"),
-            InlineKeyboardButton(text="🗑", callback_data=f"key_del_{k['id']}"),
-        ]
-        buttons.append(row)
-    buttons.append([InlineKeyboardButton(text="◀️ Назад", callback_data="menu")])
-
-    await callback.message.edit_text(text, reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons))
+        status = "✅" if k["is_active"] else "❌"
+        balance = f"{k['pollen_balance']:.2f}" if k["pollen_balance"] is not None else "?"
+        masked = _mask(k["key"])
+        vless_info = f" → {k['vless_remark']}" if k.get("vless_remark") else " (без VLESS)"
+        lines.append(f"{status} <code>{masked}</code> — {balance} p{vless_info}")
+        builder.row(
+            _button(text=f"🔗 {masked}", callback_data=KeyCb(action="bind", id=k["id"]).pack()),
+            _button(text="🗑", callback_data=KeyCb(action="del", id=k["id"]).pack()),
+        )
+    text = "\n".join(lines) if keys else "🔑 <b>Ключи</b>\n\nНет ключей."
+    builder.row(_button(text="◀️ Назад", callback_data="menu"))
+
+    await callback.message.edit_text(text, reply_markup=builder.as_markup())
     await callback.answer()
 
 
 @router.callback_query(F.data == "key_add")
 async def cb_key_add(callback: CallbackQuery, state: FSMContext):
-    if not is_admin(callback.from_user.id):
-        return
     await state.set_state(AddKey.waiting_key)
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="❌ Отмена", callback_data="keys")],
-    ])
-    await callback.message.edit_text("🔑 Отправьте API ключ Pollinations:", reply_markup=kb)
+    await callback.message.edit_text("🔑 Отправьте API ключ Pollinations:", reply_markup=CANCEL_KEYS_KB)
     await callback.answer()
 
 
 @router.message(AddKey.waiting_key)
 async def on_key_input(message: Message, state: FSMContext):
-    if not is_admin(message.from_user.id):
-        return
     key = message.text.strip()
     await message.answer("⏳ Проверяю ключ...")
 
-    socks_port = 10801 if is_xray_running() else None
+    socks_port = get_xray_socks_port()
     valid = await validate_key(key, socks_port)
     if not valid:
         await message.answer("❌ Ключ невалиден. Попробуйте /start")
@@ -164,136 +202,142 @@ async def on_key_input(message: Message, state: FSMContext):
     # Предлагаем привязать к VLESS
     vless_configs = await models.get_all_vless()
     if vless_configs:
-        buttons = []
+        builder = InlineKeyboardBuilder()
         for v in vless_configs:
             remark = v["remark"] or f"config-{v['config_index']}"
-            buttons.append([InlineKeyboardButton(
+            builder.row(_button(
                 text=f"🌐 {remark}",
-                callback_data=f"key_bind_vless_{v['id']}",
-            )])
-        buttons.append([InlineKeyboardButton(text="⏭ Без привязки", callback_data="key_bind_vless_none")])
-        kb = InlineKeyboardMarkup(inline_keyboard=buttons)
+                callback_data=KeyCb(action="bind_new", vless_id=v["id"]).pack(),
+            ))
+        builder.row(_button(text="⏭ Без привязки", callback_data=KeyCb(action="bind_new").pack()))
         await state.set_state(AddKey.waiting_vless_bind)
-        await message.answer("✅ Ключ валиден! Привяжите к VLESS конфигу:", reply_markup=kb)
+        await message.answer("✅ Ключ валиден! Привяжите к VLESS конфигу:", reply_markup=builder.as_markup())
     else:
         # Нет VLESS — сохраняем без привязки
         await _save_new_key(message, state, key, None, socks_port)
 
 
-@router.callback_query(F.data.startswith("key_bind_vless_"), AddKey.waiting_vless_bind)
-async def cb_key_bind_vless(callback: CallbackQuery, state: FSMContext):
-    if not is_admin(callback.from_user.id):
-        return
+@router.callback_query(KeyCb.filter(F.action == "bind_new"), AddKey.waiting_vless_bind)
+async def cb_key_bind_vless(callback: CallbackQuery, callback_data: KeyCb, state: FSMContext):
     data = await state.get_data()
     key = data.get("new_key", "")
+    vless_id = callback_data.vless_id
 
-    vless_id_str = callback.data.replace("key_bind_vless_", "")
-    vless_id = None if vless_id_str == "none" else int(vless_id_str)
-
-    socks_port = 10801 if is_xray_running() else None
+    socks_port = get_xray_socks_port()
     await _save_new_key(callback.message, state, key, vless_id, socks_port, edit=True)
     await callback.answer()
 
 
 async def _save_new_key(message, state, key, vless_id, socks_port, edit=False):
     """Сохраняет ключ и обновляет баланс."""
-    idx = await models.add_api_key(key, vless_id)
+    key_id = await models.add_api_key(key, vless_id)
 
     result = await check_key_balance(key, socks_port)
     if result.get("balance") is not None:
-        keys = await models.get_all_keys()
-        for k in keys:
-            if k["key"] == key:
-                await models.update_key_balance(k["id"], result["balance"], result.get("next_reset_at"))
-                break
+        await models.update_key_balance(key_id, result["balance"], result.get("next_reset_at"))
 
     await state.clear()
-    masked = key[:8] + "..." + key[-4:]
+    masked = _mask(key)
     balance = result.get("balance", "?")
     text = f"✅ Ключ добавлен: <code>{masked}</code>\nБаланс: {balance} pollen"
     if vless_id:
         text += "\n🔗 Привязан к VLESS"
 
     if edit:
-        await message.edit_text(text, reply_markup=main_menu_kb())
+        await message.edit_text(text, reply_markup=MAIN_MENU_KB)
     else:
-        await message.answer(text, reply_markup=main_menu_kb())
+        await message.answer(text, reply_markup=MAIN_MENU_KB)
 
 
-@router.callback_query(F.data == "key_refresh_all")
-async def cb_key_refresh_all(callback: CallbackQuery):
-    if not is_admin(callback.from_user.id):
-        return
-    await callback.answer("⏳ Обновляю балансы...")
-
+async def _refresh_all_balances():
+    """Проверяет балансы всех ключей и пишет результат одной транзакцией."""
     keys = await models.get_all_keys()
-    for k in keys:
-        vless_idx = k.get("vless_config_index")
-        socks_port = (10801 + vless_idx) if vless_idx is not None and is_xray_running() else None
+    xray_up = is_xray_running()
+    ports = [
+        (SOCKS_BASE_PORT + k["vless_config_index"])
+        if k.get("vless_config_index") is not None and xray_up else None
+        for k in keys
+    ]
+    sem = asyncio.Semaphore(REFRESH_CONCURRENCY)
 
-        result = await check_key_balance(k["key"], socks_port)
+    async def check(key: str, socks_port: int | None) -> dict:
+        async with sem:
+            return await check_key_balance(key, socks_port)
+
+    results = await asyncio.gather(
+        *(check(k["key"], p) for k, p in zip(keys, ports)), return_exceptions=True,
+    )
+    updates = []
+    to_deactivate = []
+    for k, result in zip(keys, results):
+        if isinstance(result, BaseException):
+            logger.error("Ошибка проверки баланса ключа #%d: %s", k["id"], result)
+            continue
         balance = result.get("balance")
-        next_reset = result.get("next_reset_at")
-        await models.update_key_balance(k["id"], balance, next_reset)
+        updates.append((k["id"], balance, result.get("next_reset_at")))
 
         if balance is not None and balance < settings.balance_threshold:
-            await models.deactivate_key(k["id"])
+            to_deactivate.append(k["id"])
 
-    await cb_keys(callback)
+    await models.update_key_balances_bulk(updates, to_deactivate)
 
 
-@router.callback_query(F.data.startswith("key_bind_"))
-async def cb_key_bind(callback: CallbackQuery):
-    """Привязать существующий ключ к VLESS."""
-    if not is_admin(callback.from_user.id):
-        return
-    # key_bind_{key_id} — но не key_bind_vless_
-    if "vless" in callback.data:
+@router.callback_query(F.data == "key_refresh_all")
+async def cb_key_refresh_all(callback: CallbackQuery):
+    global _refresh_inflight
+    if _refresh_inflight is not None:
+        # Обновление уже идёт — дожидаемся его, список перерисует первое нажатие
+        await callback.answer("⏳ Уже обновляю")
+        await asyncio.shield(_refresh_inflight)
         return
 
-    key_id = int(callback.data.split("_")[2])
+    await callback.answer("⏳ Обновляю балансы...")
+    _refresh_inflight = asyncio.create_task(_refresh_all_balances())
+    try:
+        await _refresh_inflight
+    finally:
+        _refresh_inflight = None
+
+    await cb_keys(callback)
+
+
+@router.callback_query(KeyCb.filter(F.action == "bind"))
+async def cb_key_bind(callback: CallbackQuery, callback_data: KeyCb):
+    """Привязать существующий ключ к VLESS."""
+    key_id = callback_data.id
     vless_configs = await models.get_all_vless()
 
     if not vless_configs:
         await callback.answer("Нет VLESS конфигов для привязки")
         return
 
-    buttons = []
+    builder = InlineKeyboardBuilder()
     for v in vless_configs:
         remark = v["remark"] or f"config-{v['config_index']}"
-        buttons.append([InlineKeyboardButton(
+        builder.row(_button(
             text=f"🌐 {remark}",
-            callback_data=f"key_setv_{key_id}_{v['id']}",
-        )])
-    buttons.append([InlineKeyboardButton(text="🚫 Отвязать", callback_data=f"key_setv_{key_id}_none")])
-    buttons.append([InlineKeyboardButton(text="◀️ Назад", callback_data="keys")])
+            callback_data=KeyCb(action="setv", id=key_id, vless_id=v["id"]).pack(),
+        ))
+    builder.row(_button(text="🚫 Отвязать", callback_data=KeyCb(action="setv", id=key_id).pack()))
+    builder.row(_button(text="◀️ Назад", callback_data="keys"))
 
     await callback.message.edit_text(
         f"🔗 Привязка ключа #{key_id} к VLESS:",
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons),
+        reply_markup=builder.as_markup(),
     )
     await callback.answer()
 
 
-@router.callback_query(F.data.startswith("key_setv_"))
-async def cb_key_set_vless(callback: CallbackQuery):
-    if not is_admin(callback.from_user.id):
-        return
-    parts = callback.data.split("_")
-    key_id = int(parts[2])
-    vless_id = None if parts[3] == "none" else int(parts[3])
-
-    await models.bind_key_to_vless(key_id, vless_id)
+@router.callback_query(KeyCb.filter(F.action == "setv"))
+async def cb_key_set_vless(callback: CallbackQuery, callback_data: KeyCb):
+    await models.bind_key_to_vless(callback_data.id, callback_data.vless_id)
     await callback.answer("✅ Привязка обновлена")
     await cb_keys(callback)
 
 
-@router.callback_query(F.data.startswith("key_del_"))
-async def cb_key_delete(callback: CallbackQuery):
-    if not is_admin(callback.from_user.id):
-        return
-    key_id = int(callback.data.split("_")[2])
-    await models.delete_api_key(key_id)
+@router.callback_query(KeyCb.filter(F.action == "del"))
+async def cb_key_delete(callback: CallbackQuery, callback_data: KeyCb):
+    await models.delete_api_key(callback_data.id)
     await callback.answer("🗑 Ключ удалён")
     await cb_keys(callback)
 
@@ -302,50 +346,32 @@ async def cb_key_delete(callback: CallbackQuery):
 
 @router.callback_query(F.data == "vless")
 async def cb_vless(callback: CallbackQuery):
-    if not is_admin(callback.from_user.id):
-        return
     configs = await models.get_all_vless()
 
-    if not configs:
-        text = "🌐 <b>VLESS конфиги</b>\n\nНет конфигов."
-    else:
-        lines = ["🌐 <b>VLESS конфиги</b>\n"]
-        for c in configs:
-            status = "✅" if c["is_active"] else "❌"
-            remark = c["remark"] or f"config-{c['config_index']}"
-            lines.append(f"{status} {remark} (idx: {c['config_index']})")
-        text = "\n".join(lines)
-
-    buttons = [
-        [InlineKeyboardButton(text="➕ Добавить VLESS", callback_data="vless_add")],
-    ]
+    lines = ["🌐 <b>VLESS конфиги</b>\n"]
+    builder = InlineKeyboardBuilder()
+    builder.row(_button(text="➕ Добавить VLESS", callback_data="vless_add"))
     for c in configs:
+        status = "✅" if c["is_active"] else "❌"
         remark = c["remark"] or f"config-{c['config_index']}"
-        buttons.append([
-            InlineKeyboardButton(text=f"🗑 {remark}", callback_data=f"vless_del_{c['id']}"),
-        ])
-    buttons.append([InlineKeyboardButton(text="◀️ Назад", callback_data="menu")])
+        lines.append(f"{status} {remark} (idx: {c['config_index']})")
+        builder.row(_button(text=f"🗑 {remark}", callback_data=VlessCb(action="del", id=c["id"]).pack()))
+    text = "\n".join(lines) if configs else "🌐 <b>VLESS конфиги</b>\n\nНет конфигов."
+    builder.row(_button(text="◀️ Назад", callback_data="menu"))
 
-    await callback.message.edit_text(text, reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons))
+    await callback.message.edit_text(text, reply_markup=builder.as_markup())
     await callback.answer()
 
 
 @router.callback_query(F.data == "vless_add")
 async def cb_vless_add(callback: CallbackQuery, state: FSMContext):
-    if not is_admin(callback.from_user.id):
-        return
     await state.set_state(AddVless.waiting_url)
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="❌ Отмена", callback_data="vless")],
-    ])
-    await callback.message.edit_text("🌐 Отправьте VLESS URL:", reply_markup=kb)
+    await callback.message.edit_text("🌐 Отправьте VLESS URL:", reply_markup=CANCEL_VLESS_KB)
     await callback.answer()
 
 
 @router.message(AddVless.waiting_url)
 async def on_vless_input(message: Message, state: FSMContext):
-    if not is_admin(message.from_user.id):
-        return
     url = message.text.strip()
 
     parsed = parse_vless_url(url)
@@ -355,33 +381,33 @@ async def on_vless_input(message: Message, state: FSMContext):
         return
 
     remark = parsed.get("remark", "")
-    await models.add_vless(url, remark)
+    config_index = await models.add_vless(url, remark, parsed)
     await state.clear()
 
-    # Перезапускаем XRAY чтобы подхватить новый конфиг
-    urls = await models.get_active_vless_urls()
-    ok = await restart_xray(urls)
-    xray_status = "✅ XRAY перезапущен" if ok else "⚠️ Не удалось перезапустить XRAY"
+    # Добавляем туннель через API XRAY, перезапуск — только если это не вышло
+    if await add_outbound(parsed, config_index):
+        xray_status = "✅ Туннель добавлен в XRAY"
+    else:
+        configs = await models.get_active_vless_parsed()
+        ok = await restart_xray(configs)
+        xray_status = "✅ XRAY перезапущен" if ok else "⚠️ Не удалось перезапустить XRAY"
 
     await message.answer(
         f"✅ VLESS добавлен: {remark or 'без имени'}\n{xray_status}",
-        reply_markup=main_menu_kb(),
+        reply_markup=MAIN_MENU_KB,
     )
 
 
-@router.callback_query(F.data.startswith("vless_del_"))
-async def cb_vless_delete(callback: CallbackQuery):
-    if not is_admin(callback.from_user.id):
-        return
-    vless_id = int(callback.data.split("_")[2])
-    await models.delete_vless(vless_id)
+@router.callback_query(VlessCb.filter(F.action == "del"))
+async def cb_vless_delete(callback: CallbackQuery, callback_data: VlessCb):
+    config_index = await models.delete_vless(callback_data.id)
 
-    # Перезапускаем XRAY без удалённого конфига
-    urls = await models.get_active_vless_urls()
-    if urls:
-        await restart_xray(urls)
+    # Убираем туннель через API XRAY, перезапуск — только если это не вышло
+    configs = await models.get_active_vless_parsed()
+    if configs:
+        if config_index is not None and not await remove_outbound(config_index):
+            await restart_xray(configs)
     else:
-        from services.vless import stop_xray
         await stop_xray()
 
     await callback.answer("🗑 VLESS удалён, XRAY обновлён")
@@ -392,56 +418,40 @@ async def cb_vless_delete(callback: CallbackQuery):
 
 @router.callback_query(F.data == "tokens")
 async def cb_tokens(callback: CallbackQuery):
-    if not is_admin(callback.from_user.id):
-        return
     tokens = await models.get_all_tokens_stats()
 
-    if not tokens:
-        text = "🔐 <b>Токены доступа</b>\n\nНет токенов."
-    else:
-        lines = ["🔐 <b>Токены доступа</b>\n"]
-        for t in tokens:
-            status = "✅" if t["is_active"] else "❌"
-            name = t["name"] or f"token-{t['id']}"
-            masked = t["token"][:8] + "..." + t["token"][-4:]
-            lines.append(
-                f"{status} <b>{name}</b> — <code>{masked}</code>\n"
-                f"    Сегодня: {t['success_today']}/{t['today']} | Всего: {t['total']}"
-            )
-        text = "\n".join(lines)
-
-    buttons = [
-        [InlineKeyboardButton(text="➕ Создать токен", callback_data="token_create")],
-    ]
+    lines = ["🔐 <b>Токены доступа</b>\n"]
+    builder = InlineKeyboardBuilder()
+    builder.row(_button(text="➕ Создать токен", callback_data="token_create"))
     for t in tokens:
+        status = "✅" if t["is_active"] else "❌"
         name = t["name"] or f"token-{t['id']}"
+        masked = _mask(t["token"])
+        lines.append(
+            f"{status} <b>{name}</b> — <code>{masked}</code>\n"
+            f"    Сегодня: {t['success_today']}/{t['today']} | Всего: {t['total']}"
+        )
         row = []
         if t["is_active"]:
-            row.append(InlineKeyboardButton(text=f"🚫 {name}", callback_data=f"token_revoke_{t['id']}"))
-        row.append(InlineKeyboardButton(text="🗑", callback_data=f"token_del_{t['id']}"))
-        buttons.append(row)
-    buttons.append([InlineKeyboardButton(text="◀️ Назад", callback_data="menu")])
+            row.append(_button(text=f"🚫 {name}", callback_data=TokenCb(action="revoke", id=t["id"]).pack()))
+        row.append(_button(text="🗑", callback_data=TokenCb(action="del", id=t["id"]).pack()))
+        builder.row(*row)
+    text = "\n".join(lines) if tokens else "🔐 <b>Токены доступа</b>\n\nНет токенов."
+    builder.row(_button(text="◀️ Назад", callback_data="menu"))
 
-    await callback.message.edit_text(text, reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons))
+    await callback.message.edit_text(text, reply_markup=builder.as_markup())
     await callback.answer()
 
 
 @router.callback_query(F.data == "token_create")
 async def cb_token_create(callback: CallbackQuery, state: FSMContext):
-    if not is_admin(callback.from_user.id):
-        return
     await state.set_state(CreateToken.waiting_name)
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="❌ Отмена", callback_data="tokens")],
-    ])
-    await callback.message.edit_text("🔐 Введите название для токена (имя сервиса):", reply_markup=kb)
+    await callback.message.edit_text("🔐 Введите название для токена (имя сервиса):", reply_markup=CANCEL_TOKENS_KB)
     await callback.answer()
 
 
 @router.message(CreateToken.waiting_name)
 async def on_token_name(message: Message, state: FSMContext):
-    if not is_admin(message.from_user.id):
-        return
     name = message.text.strip()
     token_value = secrets.token_urlsafe(32)
     await models.create_token(token_value, name)
@@ -452,26 +462,20 @@ async def on_token_name(message: Message, state: FSMContext):
         f"<code>{token_value}</code>\n\n"
         "⚠️ Сохраните токен — он больше не будет показан полностью!\n"
         "Использование: <code>Authorization: Bearer {token}</code>",
-        reply_markup=main_menu_kb(),
+        reply_markup=MAIN_MENU_KB,
     )
 
 
-@router.callback_query(F.data.startswith("token_revoke_"))
-async def cb_token_revoke(callback: CallbackQuery):
-    if not is_admin(callback.from_user.id):
-        return
-    token_id = int(callback.data.split("_")[2])
-    await models.revoke_token(token_id)
+@router.callback_query(TokenCb.filter(F.action == "revoke"))
+async def cb_token_revoke(callback: CallbackQuery, callback_data: TokenCb):
+    await models.revoke_token(callback_data.id)
     await callback.answer("🚫 Токен отозван")
     await cb_tokens(callback)
 
 
-@router.callback_query(F.data.startswith("token_del_"))
-async def cb_token_delete(callback: CallbackQuery):
-    if not is_admin(callback.from_user.id):
-        return
-    token_id = int(callback.data.split("_")[2])
-    await models.delete_token(token_id)
+@router.callback_query(TokenCb.filter(F.action == "del"))
+async def cb_token_delete(callback: CallbackQuery, callback_data: TokenCb):
+    await models.delete_token(callback_data.id)
     await callback.answer("🗑 Токен удалён")
     await cb_tokens(callback)
 
@@ -480,11 +484,9 @@ async def cb_token_delete(callback: CallbackQuery):
 
 @router.callback_query(F.data == "menu")
 async def cb_menu(callback: CallbackQuery, state: FSMContext):
-    if not is_admin(callback.from_user.id):
-        return
     await state.clear()
     await callback.message.edit_text(
         "🛠 <b>Service Pollinations Key Swap</b>\n\nВыберите раздел:",
-        reply_markup=main_menu_kb(),
+        reply_markup=MAIN_MENU_KB,
     )
     await callback.answer()
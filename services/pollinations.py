@@ -1,15 +1,27 @@
 """Check Pollinations API key balances via SOCKS5 proxy or direct."""
 
+import asyncio
 import logging
 
 import aiohttp
 from aiohttp_socks import ProxyConnector
 
+from services.vless import get_xray_generation
+
 logger = logging.getLogger(__name__)
 
 BALANCE_URL = "https://gen.pollinations.ai/account/balance"
 PROFILE_URL = "https://gen.pollinations.ai/account/profile"
 
+# Fail fast on dead keys/tunnels so one bad key can't stall a bulk refresh
+TIMEOUT = aiohttp.ClientTimeout(total=8, sock_connect=3, sock_read=5)
+# Hard cap on a whole check_key_balance call
+CHECK_DEADLINE = 10
+
+# Cached sessions keyed by SOCKS5 port (None = direct)
+_sessions: dict[int | None, aiohttp.ClientSession] = {}
+_sessions_xray_gen = 0
+
 
 def _get_connector(socks_port: int | None = None) -> ProxyConnector | None:
     if socks_port is None:
@@ -17,33 +29,82 @@ def _get_connector(socks_port: int | None = None) -> ProxyConnector | None:
     return ProxyConnector.from_url(f"socks5://127.0.0.1:{socks_port}")
 
 
+async def _session(socks_port: int | None) -> aiohttp.ClientSession:
+    """Return a pooled session for the given SOCKS5 port, creating it on first use."""
+    global _sessions_xray_gen
+    if _sessions_xray_gen != get_xray_generation():
+        # XRAY tunnels changed: connections through the old ones are dead.
+        # Swap them out before awaiting so concurrent callers skip this block.
+        _sessions_xray_gen = get_xray_generation()
+        stale = [_sessions.pop(port) for port in list(_sessions) if port is not None]
+        for session in stale:
+            await session.close()
+
+    session = _sessions.get(socks_port)
+    if session is None or session.closed:
+        session = aiohttp.ClientSession(
+            connector=_get_connector(socks_port),
+            timeout=TIMEOUT,
+        )
+        _sessions[socks_port] = session
+    return session
+
+
+async def close_sessions():
+    """Close all cached sessions (on shutdown)."""
+    for session in _sessions.values():
+        await session.close()
+    _sessions.clear()
+
+
+async def _get_json(session: aiohttp.ClientSession, url: str, headers: dict) -> tuple[int, dict | None]:
+    async with session.get(url, headers=headers, timeout=TIMEOUT) as resp:
+        if resp.status == 200:
+            return resp.status, await resp.json()
+        return resp.status, None
+
+
+async def _fetch_balance(session: aiohttp.ClientSession, api_key: str) -> tuple[int, dict | None]:
+    return await _get_json(session, BALANCE_URL, {"Authorization": f"Bearer {api_key}"})
+
+
+async def _fetch_profile(session: aiohttp.ClientSession, api_key: str) -> tuple[int, dict | None]:
+    return await _get_json(session, PROFILE_URL, {"Authorization": f"Bearer {api_key}"})
+
+
 async def check_key_balance(api_key: str, socks_port: int | None = None) -> dict:
     """Check balance and profile for a Pollinations API key.
 
     Returns dict with: balance, tier, next_reset_at, or error.
     """
-    headers = {"Authorization": f"Bearer {api_key}"}
-    timeout = aiohttp.ClientTimeout(total=15)
     result = {}
 
     try:
-        connector = _get_connector(socks_port)
-        async with aiohttp.ClientSession(connector=connector) as session:
-            async with session.get(BALANCE_URL, headers=headers, timeout=timeout) as resp:
-                if resp.status == 200:
-                    data = await resp.json()
-                    result["balance"] = data.get("balance", 0)
-                else:
-                    result["balance"] = None
-                    result["error"] = f"Balance check failed: {resp.status}"
-
-        connector2 = _get_connector(socks_port)
-        async with aiohttp.ClientSession(connector=connector2) as session:
-            async with session.get(PROFILE_URL, headers=headers, timeout=timeout) as resp:
-                if resp.status == 200:
-                    data = await resp.json()
-                    result["tier"] = data.get("tier", "")
-                    result["next_reset_at"] = data.get("nextResetAt", "")
+        session = await _session(socks_port)
+        async with asyncio.timeout(CHECK_DEADLINE):
+            balance_resp, profile_resp = await asyncio.gather(
+                _fetch_balance(session, api_key),
+                _fetch_profile(session, api_key),
+                return_exceptions=True,
+            )
+        if isinstance(balance_resp, BaseException):
+            raise balance_resp
+        status, data = balance_resp
+        if data is not None:
+            result["balance"] = data.get("balance", 0)
+        else:
+            result["balance"] = None
+            result["error"] = f"Balance check failed: {status}"
+
+        if isinstance(profile_resp, BaseException):
+            raise profile_resp
+        _, data = profile_resp
+        if data is not None:
+            result["tier"] = data.get("tier", "")
+            result["next_reset_at"] = data.get("nextResetAt", "")
+    except asyncio.TimeoutError:
+        logger.error("Timed out checking key balance")
+        result["error"] = "Timed out"
     except Exception as e:
         logger.error("Error checking key balance: %s", e)
         result["error"] = str(e)
@@ -52,9 +113,14 @@ async def check_key_balance(api_key: str, socks_port: int | None = None) -> dict
 
 
 async def validate_key(api_key: str, socks_port: int | None = None) -> bool:
-    """Check if an API key is valid by fetching its balance."""
+    """Check if an API key is valid by fetching its balance (the profile is skipped)."""
     try:
-        result = await check_key_balance(api_key, socks_port)
-        return result.get("balance") is not None
-    except Exception:
+        session = await _session(socks_port)
+        _, data = await asyncio.wait_for(_fetch_balance(session, api_key), timeout=CHECK_DEADLINE)
+        return data is not None
+    except asyncio.TimeoutError:
+        logger.error("Timed out validating key")
+        return False
+    except Exception as e:
+        logger.error("Error validating key: %s", e)
         return False
@@ -1,13 +1,35 @@
 """Parse VLESS URLs, generate XRAY config, manage XRAY process."""
 
 import asyncio
-import json
 import logging
-from urllib.parse import parse_qs, unquote
+import os
+import re
+from urllib.parse import unquote, unquote_plus
+
+import orjson
+
+from config import settings
 
 logger = logging.getLogger(__name__)
 
+XRAY_BIN = "/usr/local/bin/xray"
+# Tunnel N listens for SOCKS5 on SOCKS_BASE_PORT + config_index
+SOCKS_BASE_PORT = 10801
+# gRPC API inbound used to add/remove tunnels without restarting XRAY.
+# Kept below SOCKS_BASE_PORT so no config_index can ever collide with it.
+XRAY_API_HOST = "127.0.0.1"
+XRAY_API_PORT = SOCKS_BASE_PORT - 1
+
 _xray_process: asyncio.subprocess.Process | None = None
+# Bumped on every successful start and tunnel add/remove so callers can drop
+# connections to old tunnels (a new tunnel may reuse a removed one's port)
+_xray_generation: int = 0
+
+# vless://uuid@host[:port][/][?query][#remark]; host may be a bracketed IPv6 literal
+_VLESS_RE = re.compile(
+    r"vless://(?P<uuid>[^@]+)@(?P<host>\[[0-9A-Fa-f:.]+\]|[^:/?#\[\]]+)(?::(?P<port>\d+))?"
+    r"/?(?:\?(?P<query>[^#]*))?(?:#(?P<remark>.*))?"
+)
 
 
 def parse_vless_url(url: str) -> dict | None:
@@ -17,38 +39,25 @@ def parse_vless_url(url: str) -> dict | None:
         logger.error("Not a VLESS URL: %s", url[:30])
         return None
 
-    remark = ""
-    if "#" in url:
-        url, remark = url.rsplit("#", 1)
-        remark = unquote(remark)
-
-    without_scheme = url[len("vless://"):]
-    if "@" not in without_scheme:
-        logger.error("Invalid VLESS URL format (no @)")
+    m = _VLESS_RE.fullmatch(url)
+    if m is None:
+        logger.error("Invalid VLESS URL format: %s", url[:30])
         return None
+    uuid_part, host, port_str, query_string, remark = m.groups()
+    port = int(port_str) if port_str else 443
+    remark = unquote(remark) if remark else ""
 
-    uuid_part, rest = without_scheme.split("@", 1)
-
-    if "?" in rest:
-        host_port, query_string = rest.split("?", 1)
-    else:
-        host_port, query_string = rest, ""
-
-    if ":" in host_port:
-        host, port_str = host_port.rsplit(":", 1)
-        port = int(port_str)
-    else:
-        host = host_port
-        port = 443
-
+    # Same semantics as parse_qs + first value: blanks dropped, first duplicate wins
     params = {}
     if query_string:
-        parsed = parse_qs(query_string)
-        params = {k: v[0] for k, v in parsed.items()}
+        for pair in query_string.split("&"):
+            k, _, v = pair.partition("=")
+            if k and v:
+                params.setdefault(unquote_plus(k), unquote_plus(v))
 
     return {
         "uuid": uuid_part,
-        "host": host,
+        "host": host.strip("[]"),
         "port": port,
         "remark": remark,
         "type": params.get("type", "tcp"),
@@ -116,105 +125,162 @@ def _build_stream_settings(cfg: dict) -> dict:
     return stream
 
 
-def generate_xray_config(vless_urls: list[str]) -> dict:
-    """Generate XRAY config with SOCKS5 inbounds and VLESS outbounds."""
-    configs = []
-    for url in vless_urls:
-        parsed = parse_vless_url(url)
-        if parsed:
-            configs.append(parsed)
+def _build_tunnel(cfg: dict, index: int) -> tuple[dict, dict, dict]:
+    """Build the SOCKS5 inbound, VLESS outbound and routing rule for one tunnel.
+
+    The SOCKS port is derived from the config_index stored in the DB, which
+    is what keys use to pick their tunnel.
+    """
+    inbound = {
+        "tag": f"socks-in-{index}",
+        "port": SOCKS_BASE_PORT + index,
+        "listen": "127.0.0.1",
+        "protocol": "socks",
+        "settings": {"udp": True},
+    }
+
+    outbound = {
+        "tag": f"vless-{index}",
+        "protocol": "vless",
+        "settings": {
+            "vnext": [{
+                "address": cfg["host"],
+                "port": cfg["port"],
+                "users": [{
+                    "id": cfg["uuid"],
+                    "encryption": cfg["encryption"],
+                }],
+            }],
+        },
+        "streamSettings": _build_stream_settings(cfg),
+    }
+
+    if cfg["flow"]:
+        outbound["settings"]["vnext"][0]["users"][0]["flow"] = cfg["flow"]
 
+    rule = {
+        "type": "field",
+        "ruleTag": f"route-{index}",
+        "inboundTag": [f"socks-in-{index}"],
+        "outboundTag": f"vless-{index}",
+    }
+    return inbound, outbound, rule
+
+
+def generate_xray_config(configs: list[dict]) -> dict:
+    """Generate XRAY config with SOCKS5 inbounds and VLESS outbounds.
+
+    Takes configs already parsed by parse_vless_url. Each may carry a
+    config_index; otherwise its position in the list is used.
+    """
     if not configs:
         return {}
 
-    inbounds = []
+    inbounds = [{
+        "tag": "api",
+        "port": XRAY_API_PORT,
+        "listen": XRAY_API_HOST,
+        "protocol": "dokodemo-door",
+        "settings": {"address": XRAY_API_HOST},
+    }]
     outbounds = []
+    rules = [{"type": "field", "inboundTag": ["api"], "outboundTag": "api"}]
 
     for i, cfg in enumerate(configs):
-        tag = f"vless-{i}"
-        socks_tag = f"socks-in-{i}"
-        port = 10801 + i
-
-        inbounds.append({
-            "tag": socks_tag,
-            "port": port,
-            "listen": "127.0.0.1",
-            "protocol": "socks",
-            "settings": {"udp": True},
-        })
-
-        outbound = {
-            "tag": tag,
-            "protocol": "vless",
-            "settings": {
-                "vnext": [{
-                    "address": cfg["host"],
-                    "port": cfg["port"],
-                    "users": [{
-                        "id": cfg["uuid"],
-                        "encryption": cfg["encryption"],
-                    }],
-                }],
-            },
-            "streamSettings": _build_stream_settings(cfg),
-        }
-
-        if cfg["flow"]:
-            outbound["settings"]["vnext"][0]["users"][0]["flow"] = cfg["flow"]
-
+        inbound, outbound, rule = _build_tunnel(cfg, cfg.get("config_index", i))
+        inbounds.append(inbound)
         outbounds.append(outbound)
-
-    rules = []
-    for i in range(len(configs)):
-        rules.append({
-            "type": "field",
-            "inboundTag": [f"socks-in-{i}"],
-            "outboundTag": f"vless-{i}",
-        })
+        rules.append(rule)
 
     return {
         "log": {"loglevel": "warning"},
+        "api": {
+            "tag": "api",
+            "services": ["HandlerService", "RoutingService", "StatsService"],
+        },
+        "stats": {},
         "inbounds": inbounds,
         "outbounds": outbounds,
         "routing": {"rules": rules},
     }
 
 
-def save_xray_config(vless_urls: list[str], path: str = "/tmp/xray_config.json") -> str | None:
+def save_xray_config(configs: list[dict], path: str = "/tmp/xray_config.json") -> str | None:
     """Generate and save XRAY config to file."""
-    config = generate_xray_config(vless_urls)
+    config = generate_xray_config(configs)
     if not config:
         return None
 
-    with open(path, "w") as f:
-        json.dump(config, f, indent=2)
+    # Compact output: the file is only read by XRAY
+    with open(path, "wb") as f:
+        f.write(orjson.dumps(config))
 
-    logger.info("XRAY config saved to %s with %d tunnels", path, len(config["inbounds"]))
+    logger.info("XRAY config saved to %s with %d tunnels", path, len(config["outbounds"]))
     return path
 
 
-async def start_xray(config_path: str = "/tmp/xray_config.json") -> bool:
-    """Start XRAY subprocess. Returns True on success."""
-    global _xray_process
+async def _wait_ready(port: int, deadline: float = 2.0) -> bool:
+    """Poll 127.0.0.1:port every 50ms until it accepts a connection or the deadline passes."""
+    loop = asyncio.get_running_loop()
+    end = loop.time() + deadline
+    while True:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+        except OSError:
+            if loop.time() >= end or not is_xray_running():
+                return False
+            await asyncio.sleep(0.05)
+        else:
+            writer.close()
+            return True
+
+
+async def start_xray(
+    config_path: str = "/tmp/xray_config.json",
+    log_path: str | None = None,
+    ready_port: int | None = None,
+) -> bool:
+    """Start XRAY subprocess. Returns True on success.
+
+    XRAY output is appended to log_path if given and discarded otherwise,
+    so there are no pipes for us to drain. If ready_port is given we wait
+    until XRAY listens on it instead of sleeping a fixed second.
+    """
+    global _xray_process, _xray_generation
     await stop_xray()
 
     try:
-        _xray_process = await asyncio.create_subprocess_exec(
-            "/usr/local/bin/xray", "run", "-config", config_path,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
-        # Give it a moment to start
-        await asyncio.sleep(1)
+        if log_path:
+            # The child keeps its own copy of the fd, ours can be closed right away
+            with open(log_path, "ab") as log_file:
+                _xray_process = await asyncio.create_subprocess_exec(
+                    XRAY_BIN, "run", "-config", config_path,
+                    stdout=log_file,
+                    stderr=log_file,
+                )
+        else:
+            _xray_process = await asyncio.create_subprocess_exec(
+                XRAY_BIN, "run", "-config", config_path,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.DEVNULL,
+            )
+        if ready_port is None:
+            # Give it a moment to start
+            await asyncio.sleep(1)
+        elif not await _wait_ready(ready_port) and _xray_process.returncode is None:
+            logger.warning("XRAY is running but port %d is not accepting connections yet", ready_port)
         if _xray_process.returncode is not None:
-            stderr = await _xray_process.stderr.read()
-            logger.error("XRAY failed to start: %s", stderr.decode()[:500])
+            logger.error(
+                "XRAY failed to start (exit code %d)%s", _xray_process.returncode,
+                f", see {log_path}" if log_path else "",
+            )
             _xray_process = None
             return False
+        _xray_generation += 1
         logger.info("XRAY started (pid=%d)", _xray_process.pid)
         return True
     except FileNotFoundError:
-        logger.error("XRAY binary not found at /usr/local/bin/xray")
+        logger.error("XRAY binary not found at %s", XRAY_BIN)
         return False
     except Exception as e:
         logger.error("Failed to start XRAY: %s", e)
@@ -237,27 +303,128 @@ async def stop_xray():
         _xray_process = None
 
 
-_xray_tunnel_count: int = 0
+# config_index of every tunnel XRAY is currently serving
+_xray_tunnels: set[int] = set()
 
 
 def is_xray_running() -> bool:
-    """Check if XRAY process is alive."""
+    """Check if XRAY process is alive.
+
+    Reads only in-memory state (returncode is set by the asyncio child
+    watcher), so it is cheap enough to call per request without caching.
+    """
     return _xray_process is not None and _xray_process.returncode is None
 
 
+def get_xray_generation() -> int:
+    """Return a counter that changes every time XRAY is (re)started or its tunnels change."""
+    return _xray_generation
+
+
 def get_xray_tunnel_count() -> int:
-    """Return the number of tunnels XRAY was started with."""
-    return _xray_tunnel_count
+    """Return the number of tunnels XRAY is currently serving."""
+    return len(_xray_tunnels)
+
+
+def get_xray_socks_port() -> int | None:
+    """Return the SOCKS5 port of any live tunnel, or None if XRAY is down."""
+    if not _xray_tunnels or not is_xray_running():
+        return None
+    return SOCKS_BASE_PORT + min(_xray_tunnels)
 
 
-async def restart_xray(vless_urls: list[str]) -> bool:
-    """Regenerate config and restart XRAY."""
-    global _xray_tunnel_count
-    path = save_xray_config(vless_urls)
+async def restart_xray(configs: list[dict]) -> bool:
+    """Regenerate config from parsed VLESS configs and restart XRAY."""
+    path = save_xray_config(configs)
     if not path:
         logger.warning("No VLESS configs, XRAY not started")
         return False
-    ok = await start_xray(path)
+    indexes = {cfg.get("config_index", i) for i, cfg in enumerate(configs)}
+    ok = await start_xray(path, settings.xray_log_path or None, SOCKS_BASE_PORT + min(indexes))
+    if ok:
+        _xray_tunnels.clear()
+        _xray_tunnels.update(indexes)
+    return ok
+
+
+async def _xray_api(command: str, *args: str) -> bool:
+    """Run `xray api <command>` against the running instance."""
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            XRAY_BIN, "api", command, f"--server={XRAY_API_HOST}:{XRAY_API_PORT}", *args,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+    except OSError as e:
+        logger.error("Failed to run xray api %s: %s", command, e)
+        return False
+    try:
+        stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=5)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        logger.error("xray api %s timed out", command)
+        return False
+    if proc.returncode != 0:
+        output = (stderr or stdout).decode(errors="replace").strip()
+        logger.error("xray api %s failed: %s", command, output[:500])
+        return False
+    return True
+
+
+async def add_outbound(cfg: dict, index: int) -> bool:
+    """Add one tunnel to the running XRAY through its API.
+
+    Returns False if XRAY is down or the API call fails; callers should
+    fall back to restart_xray then.
+    """
+    global _xray_generation
+    if not is_xray_running():
+        return False
+    if index in _xray_tunnels:
+        return True
+
+    inbound, outbound, rule = _build_tunnel(cfg, index)
+    path = f"/tmp/xray_tunnel_{index}.json"
+    with open(path, "wb") as f:
+        f.write(orjson.dumps({
+            "inbounds": [inbound],
+            "outbounds": [outbound],
+            "routing": {"rules": [rule]},
+        }))
+    try:
+        ok = (
+            await _xray_api("ado", path)
+            and await _xray_api("adi", path)
+            and await _xray_api("adrules", "-append", path)
+        )
+    finally:
+        os.remove(path)
+    if ok:
+        _xray_tunnels.add(index)
+        _xray_generation += 1
+        logger.info("XRAY tunnel %d added on port %d", index, inbound["port"])
+    return ok
+
+
+async def remove_outbound(index: int) -> bool:
+    """Remove one tunnel from the running XRAY through its API.
+
+    Returns False if XRAY is down or the API call fails; callers should
+    fall back to restart_xray then.
+    """
+    global _xray_generation
+    if not is_xray_running():
+        return False
+
+    # Without -tags, rmi/rmo treat their arguments as config file paths
+    ok = (
+        await _xray_api("rmrules", f"route-{index}")
+        and await _xray_api("rmi", "-tags", f"socks-in-{index}")
+        and await _xray_api("rmo", "-tags", f"vless-{index}")
+    )
     if ok:
-        _xray_tunnel_count = len(vless_urls)
+        _xray_tunnels.discard(index)
+        _xray_generation += 1
+        logger.info("XRAY tunnel %d removed", index)
     return ok